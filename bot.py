@@ -3,7 +3,10 @@
 # TODO # - !suggest
 # TODO # - welcome
 
+import asyncio
 import functools
+import glob
+import itertools
 import os
 import random
 import math
@@ -19,18 +22,39 @@ from discord.utils import get
 from matplotlib import pyplot as plt
 from discord import Activity, ActivityType, File, Intents, DiscordException
 from dotenv import load_dotenv
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 # General settings
-from matplotlib.ticker import StrMethodFormatter
+from matplotlib.ticker import MaxNLocator, StrMethodFormatter
 
 COMMAND_PREFIX = "!"
 IGNORE_EXISTING_DB = True
 
+# Popularity snapshot settings
+SNAPSHOT_TABLE = "popularity_snapshots"
+SNAPSHOT_INTERVAL_HOURS = 1
+TREND_DAYS = 365
+# Snapshots older than the given number of days are merged into buckets of the given size (in seconds), and those
+# older than TREND_DAYS into a single baseline per game
+SNAPSHOT_DOWNSAMPLE_TIERS = [(7, 24 * 3600), (90, 7 * 24 * 3600)]
+
+# Backup settings
+BACKUP_INTERVAL_HOURS = 24
+BACKUP_KEEP = 7
+# Copy this many pages per backup step and pause this many seconds after each step (or retry after this many seconds
+# when the database is busy), such that writes are never held up long
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_STEP_SLEEP = 0.05
+# A write by the bot restarts the copy, after this many restarts the rest is copied in one step instead
+BACKUP_MAX_RESTARTS = 3
+# Give up on a backup that takes longer than this many seconds
+BACKUP_TIMEOUT = 600
+
 # Setting variables
 load_dotenv()
 DB_PATH = os.getenv('SQLITE_DB')
 TOKEN = os.getenv('DISCORD_TOKEN')
+BACKUP_DIR = os.getenv('SQLITE_BACKUP_DIR', os.path.join("db", "backups"))
 ALLOWED_GUILDS = []
 
 # Create disco game bot
@@ -44,6 +68,9 @@ sql_connection = None
 user_id_col = "user_id"
 user_name_col = "user_name"
 game_col = "game"
+guild_col = "guild"
+timestamp_col = "timestamp"
+delta_col = "delta"
 
 # Some discord colors
 discord_blue = "#7087E4"
@@ -113,26 +140,47 @@ def status_update(func):
     return wrapper
 
 
+# Apply the discord look to a plot
+def style_plot(ax):
+    # Despine
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.spines['bottom'].set_visible(False)
+    ax.spines['top'].set_visible(True)
+    ax.spines['left'].set_color(discord_blue)
+    ax.spines['left'].set_linewidth(2)
+
+    # Set background colors
+    ax.set_facecolor(discord_gray)
+    ax.get_figure().patch.set_facecolor(discord_gray)
+
+    # Set tick colors and size
+    ax.tick_params(colors=discord_white, labelsize=12)
+
+
+# Store a plot to a random file for sending over discord
+def save_plot(ax):
+    # Tight layout
+    plt.tight_layout()
+
+    # Store as a figure to a random file
+    fig = ax.get_figure()
+    fn = ''.join(random.choice(string.ascii_lowercase) for _ in range(16)) + ".png"  # random filename
+    fn = os.path.join("db", fn)
+    fig.savefig(fn)
+
+    # Clear all figures
+    plt.clf()
+
+    return fn
+
+
 # Plot a pandas series in a histogram
 def plot_hist(counts):
     with plt.style.context("seaborn-dark"):
         # First plot its unique values in a horizontal bar graph
         ax = counts.plot.barh(color=discord_blue)
-
-        # Despine
-        ax.spines['right'].set_visible(False)
-        ax.spines['top'].set_visible(False)
-        ax.spines['bottom'].set_visible(False)
-        ax.spines['top'].set_visible(True)
-        ax.spines['left'].set_color(discord_blue)
-        ax.spines['left'].set_linewidth(2)
-
-        # Set background colors
-        ax.set_facecolor(discord_gray)
-        ax.get_figure().patch.set_facecolor(discord_gray)
-
-        # Set tick colors and size
-        ax.tick_params(colors=discord_white, labelsize=12)
+        style_plot(ax)
 
         # Set yticks to whole numbers (integers)
         xint = range(min(counts), math.ceil(max(counts)) + 1)
@@ -149,22 +197,327 @@ def plot_hist(counts):
         # Set y-axis label
         ax.set_ylabel("# Registered", labelpad=20, weight='bold', size=12, color=discord_white)
 
-        # Tight layout
-        plt.tight_layout()
+        fn = save_plot(ax)
+
+    # Return the file such that it can be send and deleted
+    return fn
+
+
+# Plot a pandas time series of registration counts in a line chart
+def plot_trend(counts):
+    with plt.style.context("seaborn-dark"):
+        # Counts only change at a snapshot, so draw them as steps
+        ax = counts.plot(drawstyle="steps-post", color=discord_blue, linewidth=2)
+        style_plot(ax)
+
+        # Set yticks to whole numbers (integers) starting at zero
+        ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+        ax.set_ylim(bottom=0)
+
+        # Draw horizontal axis lines
+        vals = ax.get_yticks()
+        for tick in vals:
+            ax.axhline(y=tick, linestyle='dashed', alpha=0.4, color=discord_blue, zorder=1)
+
+        # Set x-axis label
+        ax.set_xlabel("Date", labelpad=20, weight='bold', size=12, color=discord_white)
 
-        # Store as a figure to a random file for sending over discord
-        fig = ax.get_figure()
-        fn = ''.join(random.choice(string.ascii_lowercase) for _ in range(16)) + ".png"  # random filename
-        fn = os.path.join("db", fn)
-        fig.savefig(fn)
+        # Set y-axis label
+        ax.set_ylabel("# Registered", labelpad=20, weight='bold', size=12, color=discord_white)
 
-        # Clear all figures
-        plt.clf()
+        fn = save_plot(ax)
 
     # Return the file such that it can be send and deleted
     return fn
 
 
+# Create the snapshot table and its range index if they do not exist yet
+def create_snapshot_table():
+    # Each row only stores the change (delta) in registrations of a game since the previous snapshot
+    sql_connection.execute(f"CREATE TABLE IF NOT EXISTS {SNAPSHOT_TABLE} ({guild_col} TEXT, {game_col} TEXT, "
+                           f"{timestamp_col} INTEGER, {delta_col} INTEGER)")
+
+    # Covering index so both the range scans of !trend and the count totals never touch the table itself
+    sql_connection.execute(f"CREATE INDEX IF NOT EXISTS {SNAPSHOT_TABLE}_range ON {SNAPSHOT_TABLE} "
+                           f"({guild_col}, {game_col}, {timestamp_col}, {delta_col})")
+    sql_connection.commit()
+
+
+# Store the changes in registration counts of every game since the previous snapshot
+def snapshot_popularity(now):
+    for g in ALLOWED_GUILDS:
+        guild_name = guild_sql_table(g)
+
+        # The current counts, and the counts at the previous snapshot as the sum of all its deltas
+        current = dict(sql_connection.execute(f"SELECT {game_col}, COUNT(*) FROM {guild_name} GROUP BY {game_col}"))
+        previous = dict(sql_connection.execute(f"SELECT {game_col}, SUM({delta_col}) FROM {SNAPSHOT_TABLE} "
+                                               f"WHERE {guild_col} = ? GROUP BY {game_col}", (guild_name,)))
+
+        # Only store games whose count changed, games that are no longer registered drop to zero
+        rows = []
+        for game in set(current).union(previous):
+            delta = current.get(game, 0) - previous.get(game, 0)
+            if delta != 0:
+                rows.append((guild_name, game, now, delta))
+
+        sql_connection.executemany(f"INSERT INTO {SNAPSHOT_TABLE} VALUES (?, ?, ?, ?)", rows)
+
+    sql_connection.commit()
+
+
+# Merge old snapshots into coarser time buckets to keep the storage bounded
+def downsample_snapshots(now):
+    pairs = sql_connection.execute(f"SELECT DISTINCT {guild_col}, {game_col} FROM {SNAPSHOT_TABLE}").fetchall()
+
+    for age_days, bucket_size in SNAPSHOT_DOWNSAMPLE_TIERS + [(TREND_DAYS, None)]:
+        cutoff = now - age_days * 24 * 3600
+
+        # Snapshots older than the trend period are never plotted, so they all go into one bucket as the baseline
+        if bucket_size is None:
+            bucket_size = cutoff
+
+        for guild_name, game in pairs:
+            # Get the snapshots before the cutoff with a range scan over the index
+            rows = sql_connection.execute(f"SELECT {timestamp_col}, {delta_col} FROM {SNAPSHOT_TABLE} "
+                                          f"WHERE {guild_col} = ? AND {game_col} = ? AND {timestamp_col} < ? "
+                                          f"ORDER BY {timestamp_col}", (guild_name, game, cutoff)).fetchall()
+
+            # Replace each bucket that holds more than one snapshot by a single snapshot at the end of the bucket, the
+            # summed deltas keep the counts intact
+            for bucket, snapshots in itertools.groupby(rows, key=lambda row: row[0] // bucket_size):
+                snapshots = list(snapshots)
+                if len(snapshots) == 1:
+                    continue
+
+                start = bucket * bucket_size
+                end = min(start + bucket_size, cutoff)
+                sql_connection.execute(f"DELETE FROM {SNAPSHOT_TABLE} WHERE {guild_col} = ? AND {game_col} = ? "
+                                       f"AND {timestamp_col} >= ? AND {timestamp_col} < ?",
+                                       (guild_name, game, start, end))
+
+                delta = sum(d for _, d in snapshots)
+                if delta != 0:
+                    sql_connection.execute(f"INSERT INTO {SNAPSHOT_TABLE} VALUES (?, ?, ?, ?)",
+                                           (guild_name, game, snapshots[-1][0], delta))
+
+    sql_connection.commit()
+
+
+# Get the registration counts of a game over time
+def get_trend(guild_name, game, since, now):
+    params = (guild_sql_table(guild_name), game, since)
+
+    # The count at the start of the requested period
+    count = sql_connection.execute(f"SELECT COALESCE(SUM({delta_col}), 0) FROM {SNAPSHOT_TABLE} WHERE {guild_col} = ? "
+                                   f"AND {game_col} = ? AND {timestamp_col} < ?", params).fetchone()[0]
+
+    # The changes within the requested period
+    rows = sql_connection.execute(f"SELECT {timestamp_col}, {delta_col} FROM {SNAPSHOT_TABLE} WHERE {guild_col} = ? "
+                                  f"AND {game_col} = ? AND {timestamp_col} >= ? ORDER BY {timestamp_col}",
+                                  params).fetchall()
+
+    # If the game was never registered within this period there is no trend
+    if count == 0 and len(rows) == 0:
+        return None
+
+    # Accumulate the deltas to counts, and extend the last known count up to now
+    timestamps = [since]
+    counts = [count]
+    for timestamp, delta in rows:
+        count += delta
+        timestamps.append(timestamp)
+        counts.append(count)
+    timestamps.append(now)
+    counts.append(count)
+
+    return pd.Series(counts, index=pd.to_datetime(timestamps, unit="s"))
+
+
+# Create the tables of all allowed guilds that are not in the database yet
+def create_guild_tables():
+    existing = {name for name, in sql_connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    # Prep database using Pandas and SQLite (because I suck at SQL)
+    for g in ALLOWED_GUILDS:
+        if guild_sql_table(g) not in existing:
+            guild_df = pd.DataFrame(columns=[user_id_col, user_name_col, game_col])
+            guild_df.to_sql(guild_sql_table(g), sql_connection, if_exists="replace", index=False)
+
+
+# Check a database for corruption, the quick check skips the (slow) index verification
+def verify_database(connection, quick=False):
+    pragma = "quick_check" if quick else "integrity_check"
+    try:
+        result = connection.execute(f"PRAGMA {pragma}").fetchall()
+    except sqlite3.OperationalError:
+        # A locked or unreadable database says nothing about corruption, so leave that to the caller
+        raise
+    except sqlite3.DatabaseError:
+        return False
+
+    return result == [("ok",)]
+
+
+# Check if a database holds any rows at all
+def database_has_data(path):
+    connection = sqlite3.connect(path)
+    try:
+        tables = [name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        return any(connection.execute(f'SELECT 1 FROM "{name}" LIMIT 1').fetchone() for name in tables)
+    finally:
+        connection.close()
+
+
+# Get the paths of all backups, from oldest to newest
+def list_backups():
+    db_name = os.path.splitext(os.path.basename(DB_PATH))[0]
+    return sorted(glob.glob(os.path.join(BACKUP_DIR, f"{db_name}-*.bak")))
+
+
+# Get the path for a new backup
+def new_backup_path():
+    db_name = os.path.splitext(os.path.basename(DB_PATH))[0]
+    return os.path.join(BACKUP_DIR, f"{db_name}-{time.strftime('%Y%m%d-%H%M%S')}.bak")
+
+
+# Copy the database to a backup file in small steps, this blocks so it should run in a worker thread
+def backup_database(backup_path):
+    tmp_path = backup_path + ".tmp"
+    deadline = time.monotonic() + BACKUP_TIMEOUT
+    last_remaining = None
+    restarts = 0
+
+    # Pause after every step such that the bot can write in between, which restarts the copy from the first page
+    def pause_step(status, remaining, total):
+        nonlocal last_remaining, restarts
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+        last_remaining = remaining
+
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"The backup {backup_path} did not finish within {BACKUP_TIMEOUT} seconds.")
+        if restarts > BACKUP_MAX_RESTARTS:
+            raise InterruptedError()
+        if remaining > 0:
+            time.sleep(BACKUP_STEP_SLEEP)
+
+    # Use separate connections, the bot's own connection can only be used from the event loop thread
+    source = sqlite3.connect(DB_PATH)
+    target = sqlite3.connect(tmp_path)
+    try:
+        try:
+            # Every step only locks the database for a few pages. SQLite itself only sleeps when it is busy or locked.
+            try:
+                source.backup(target, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP, progress=pause_step)
+            except InterruptedError:
+                # The bot keeps writing, so copy everything in one step, which only holds up its writes briefly
+                source.backup(target, sleep=BACKUP_STEP_SLEEP)
+            valid = verify_database(target)
+        finally:
+            target.close()
+            source.close()
+
+        # Only keep the backup if it is intact, otherwise it could replace a good one during rotation
+        if not valid:
+            raise sqlite3.DatabaseError(f"The backup {backup_path} failed its integrity check.")
+        os.replace(tmp_path, backup_path)
+
+    # Never leave a partial backup behind
+    except (OSError, sqlite3.Error):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Remove all but the newest backups
+def rotate_backups():
+    backups = list_backups()
+    to_remove = backups[:-BACKUP_KEEP]
+
+    # Keep the newest backup that holds data, so backups of an empty (reset) database never push out the good ones
+    if len(to_remove) > 0 and not any(database_has_data(b) for b in backups[-BACKUP_KEEP:]):
+        for backup_path in reversed(to_remove):
+            if database_has_data(backup_path):
+                to_remove.remove(backup_path)
+                break
+
+    for backup_path in to_remove:
+        os.remove(backup_path)
+
+
+# Move the database and its journal aside, without overwriting an earlier one
+def move_database_aside(suffix):
+    aside_path = f"{DB_PATH}.{suffix}"
+    n = 1
+    while os.path.exists(aside_path):
+        aside_path = f"{DB_PATH}.{suffix}.{n}"
+        n += 1
+
+    os.replace(DB_PATH, aside_path)
+    for journal in ("-journal", "-wal"):
+        if os.path.exists(DB_PATH + journal):
+            os.replace(DB_PATH + journal, aside_path + journal)
+
+    return aside_path
+
+
+# Restore the database from a backup via a temporary file, such that a failed restore never leaves a partial database
+def restore_database(backup_path):
+    tmp_path = DB_PATH + ".tmp"
+    backup = sqlite3.connect(backup_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        backup.backup(target)
+        valid = verify_database(target)
+    except sqlite3.Error as error:
+        print(error, file=sys.stderr)
+        valid = False
+    finally:
+        target.close()
+        backup.close()
+
+    # Only put the restored database in place if it is intact
+    if valid:
+        os.replace(tmp_path, DB_PATH)
+    elif os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    return valid
+
+
+# Reopen the existing database, or restore it from the newest intact backup if it is corrupt or missing
+def load_database():
+    global sql_connection
+    if os.path.exists(DB_PATH):
+        connection = sqlite3.connect(DB_PATH)
+        try:
+            intact = verify_database(connection, quick=True)
+        except sqlite3.OperationalError:
+            # Never replace a database that is merely locked or unreadable right now
+            connection.close()
+            raise
+
+        if intact:
+            sql_connection = connection
+            return True
+
+        # Move the corrupt database aside instead of throwing it away
+        connection.close()
+        aside_path = move_database_aside("corrupt")
+        print(f"The database {DB_PATH} is corrupt, moved it to {aside_path} and trying to restore it from a backup.",
+              file=sys.stderr)
+    else:
+        print(f"The database {DB_PATH} is missing, trying to restore it from a backup.", file=sys.stderr)
+
+    for backup_path in reversed(list_backups()):
+        if restore_database(backup_path):
+            sql_connection = sqlite3.connect(DB_PATH)
+            print(f"Restored the database from {backup_path}.", file=sys.stderr)
+            return True
+
+    return False
+
+
 # Get games of some user
 async def get_games(ctx, user_name, n_games):
     # Get the channel
@@ -252,21 +605,43 @@ async def get_games(ctx, user_name, n_games):
 # When the bot is ready
 @disco.event
 async def on_ready():
-    # Check if we have an existing database
+    # This is also called after a reconnect, in which case we keep using the open database
     global sql_connection
-    if os.path.exists(DB_PATH) and not IGNORE_EXISTING_DB:
-        sql_connection = sqlite3.connect(DB_PATH)
-        loaded_db = True
-    else:
+    if sql_connection is not None:
+        print(f'{disco.user.name} has reconnected to Discord!')
+        return
+
+    # Check if we have an existing database that we can reuse
+    loaded_db = False
+    if not IGNORE_EXISTING_DB:
+        loaded_db = load_database()
+
+    # Otherwise start with an empty one
+    if not loaded_db:
+        # Back up the database we are about to throw away, or move it aside if that fails
         if os.path.exists(DB_PATH):
-            os.remove(DB_PATH)
+            try:
+                os.makedirs(BACKUP_DIR, exist_ok=True)
+                backup_path = new_backup_path()
+                backup_database(backup_path)
+                os.remove(DB_PATH)
+                print(f"Backed up the old database to {backup_path}.", file=sys.stderr)
+            except (OSError, sqlite3.Error) as error:
+                print(error, file=sys.stderr)
+                print(f"Moved the old database to {move_database_aside('old')}.", file=sys.stderr)
         sql_connection = sqlite3.connect(DB_PATH)
-        loaded_db = False
 
-        # Prep database using Pandas and SQLite (because I suck at SQL)
-        for g in ALLOWED_GUILDS:
-            guild_df = pd.DataFrame(columns=[user_id_col, user_name_col, game_col])
-            guild_df.to_sql(guild_sql_table(g), sql_connection, if_exists="replace", index=False)
+    # Prep the tables of any guilds that are new to the database
+    create_guild_tables()
+
+    # Prep the popularity history and start taking snapshots
+    create_snapshot_table()
+    if not take_snapshots.is_running():
+        take_snapshots.start()
+
+    # Start making backups
+    if not take_backups.is_running():
+        take_backups.start()
 
     # Print connection
     if loaded_db:
@@ -318,6 +693,44 @@ async def on_member_join(member):
                        "`!list` respectively. To view who plays a certain game use `!whoplays`. See `!help` for a "
                        "complete explanation of everything I can do.")
 
+
+# Periodically store the popularity of each game
+@tasks.loop(hours=SNAPSHOT_INTERVAL_HOURS)
+async def take_snapshots():
+    now = int(time.time())
+    try:
+        snapshot_popularity(now)
+        downsample_snapshots(now)
+    except sqlite3.Error as error:
+        # Undo a partial snapshot and try again next time, instead of stopping the loop for good
+        sql_connection.rollback()
+        print(error, file=sys.stderr)
+
+
+# Periodically back up the database without blocking the event loop
+@tasks.loop(hours=BACKUP_INTERVAL_HOURS)
+async def take_backups():
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+
+        # Run the stepwise copy in a worker thread, such that commands are handled while it pauses between steps
+        await asyncio.get_running_loop().run_in_executor(None, backup_database, new_backup_path())
+
+        rotate_backups()
+    except (OSError, sqlite3.Error) as error:
+        # A failed backup should not stop the next ones
+        print(error, file=sys.stderr)
+
+
+# Wait with the first backup until the newest one is an interval old, such that restarts neither skip nor repeat backups
+@take_backups.before_loop
+async def delay_backups():
+    backups = list_backups()
+    if len(backups) > 0:
+        age = time.time() - os.path.getmtime(backups[-1])
+        await asyncio.sleep(max(0, BACKUP_INTERVAL_HOURS * 3600 - age))
+
+
 #####################
 # Listen to commands
 #####################
@@ -667,6 +1080,41 @@ async def get_members(ctx, *, game):
             await channel.send(mssg)
 
 
+# Show how the popularity of a game changed over time
+@disco.command("trend")
+@status_update
+async def view_trend(ctx, *, game):
+    """ <game>  Shows how many server members registered a game over the past year.
+
+    Plots the number of people in this server that had the given game registered over time (e.g. !trend Minecraft).
+    Only one game can be queried at a time, though it is not case sensitive.
+    """
+
+    # Get the channel
+    channel = ctx.message.channel
+
+    # Format the game name
+    game = game.title()
+
+    # Get the registration counts over the past period
+    now = int(time.time())
+    counts = get_trend(ctx.guild.name, game, now - TREND_DAYS * 24 * 3600, now)
+
+    # If nobody registered the game we end here
+    if counts is None:
+        await channel.send(style(f"It seems nobody registered {game} in the last {TREND_DAYS} days {em_sad}"))
+        return
+
+    # Wrap the counts in a pretty figure
+    fn = plot_trend(counts)
+
+    # Send the message and figure
+    await channel.send(content=style(f"This is how popular {game} has been in this server:"), file=File(fn))
+
+    # Remove figure
+    os.remove(fn)
+
+
 def run_bot(test_mode=False, reset_databases=False):
     global ALLOWED_GUILDS, IGNORE_EXISTING_DB
     IGNORE_EXISTING_DB = reset_databases